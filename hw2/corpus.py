@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Reading and encoding of the bitext shared by the hw2 aligners
+import hashlib
+import itertools
+import os
+import numpy as np
+from functools import lru_cache
+
+STEM_CACHE_SIZE = 1 << 18 # distinct word types remembered by each stemmer
+
+def read_bitext(f_data, e_data, num_sents=None, stem=False):
+    # Yields the (French, English) token lists of the first num_sents lines
+    # without reading the rest of the files. With stem, tokens are lowercased
+    # and stemmed.
+    if stem:
+        (f_stem, e_stem) = (Stemmer("french"), Stemmer("english"))
+    with open(f_data) as f_file, open(e_data) as e_file:
+        for (f_sentence, e_sentence) in itertools.islice(zip(f_file, e_file), num_sents):
+            f_tokens = f_sentence.strip().split()
+            e_tokens = e_sentence.strip().split()
+            if stem:
+                f_tokens = f_stem.stem_sentence(f_tokens)
+                e_tokens = e_stem.stem_sentence(e_tokens)
+            yield [f_tokens, e_tokens]
+
+
+class Stemmer:
+    # Snowball (French) or Porter (English) stemming, memoized per word type.
+    # Neither stemmer needs any nltk data packages, so nothing is downloaded.
+    def __init__(self, language, cache_size=STEM_CACHE_SIZE):
+        from nltk.stem import PorterStemmer, SnowballStemmer
+        stemmer = PorterStemmer() if language == "english" else SnowballStemmer(language)
+        self.stem = lru_cache(maxsize=cache_size)(lambda token: stemmer.stem(token.lower()))
+
+    def stem_sentence(self, tokens):
+        return [self.stem(token) for token in tokens]
+
+
+class EncodedBitext:
+    # Both sides of the bitext as integer word ids. Sentence k is
+    # f_ids[f_start[k]:f_start[k+1]] on the French side, likewise for English.
+    def __init__(self, bitext, f_vocab=None, e_vocab=None):
+        # Words missing from the given vocabularies get new ids after theirs
+        self.f_vocab = dict(f_vocab or {})
+        self.e_vocab = dict(e_vocab or {})
+        f_ids, e_ids, f_lens, e_lens = [], [], [], []
+        for f_sent, e_sent in bitext:
+            f_ids.extend(self.f_vocab.setdefault(f_i, len(self.f_vocab)) for f_i in f_sent)
+            e_ids.extend(self.e_vocab.setdefault(e_j, len(self.e_vocab)) for e_j in e_sent)
+            f_lens.append(len(f_sent))
+            e_lens.append(len(e_sent))
+        self.set_arrays(np.array(f_ids, dtype=np.int64), np.array(e_ids, dtype=np.int64),
+                        np.array(f_lens, dtype=np.int64), np.array(e_lens, dtype=np.int64))
+
+    def set_arrays(self, f_ids, e_ids, f_lens, e_lens):
+        self.f_ids = f_ids
+        self.e_ids = e_ids
+        self.f_lens = f_lens
+        self.e_lens = e_lens
+        self.f_start = np.concatenate(([0], np.cumsum(self.f_lens)))
+        self.e_start = np.concatenate(([0], np.cumsum(self.e_lens)))
+
+    def __len__(self):
+        return len(self.f_lens)
+
+    def shards(self, size):
+        # Consecutive sentence ranges [lo, hi) holding about `size` pairs each
+        ends = np.cumsum(self.f_lens * self.e_lens)
+        lo = 0
+        while lo < len(self):
+            hi = int(np.searchsorted(ends, (ends[lo-1] if lo else 0) + size, side="right"))
+            hi = max(hi, lo + 1)
+            yield lo, hi
+            lo = hi
+
+    def pairs(self, lo, hi):
+        # Every (i, j) position pair of sentences lo..hi-1, row-major within each
+        # sentence. Returns the sentence offset from lo along with i and j.
+        f_lens = self.f_lens[lo:hi]
+        e_lens = self.e_lens[lo:hi]
+        sizes = f_lens * e_lens
+        sent = np.repeat(np.arange(hi - lo), sizes)
+        k = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return sent, k // e_lens[sent], k % e_lens[sent]
+
+    def with_vocab(self, f_vocab, e_vocab):
+        # The same bitext with ids from the given vocabularies, extended by any
+        # words they lack
+        corpus = EncodedBitext([], f_vocab, e_vocab)
+        f_map = np.array([corpus.f_vocab.setdefault(w, len(corpus.f_vocab)) for w in sorted(self.f_vocab, key=self.f_vocab.get)], dtype=np.int64)
+        e_map = np.array([corpus.e_vocab.setdefault(w, len(corpus.e_vocab)) for w in sorted(self.e_vocab, key=self.e_vocab.get)], dtype=np.int64)
+        corpus.set_arrays(f_map[self.f_ids], e_map[self.e_ids], self.f_lens, self.e_lens)
+        return corpus
+
+    def sentences(self, lo, hi):
+        # Sentence pairs lo..hi-1, sharing this bitext's vocabularies
+        corpus = EncodedBitext([])
+        (corpus.f_vocab, corpus.e_vocab) = (self.f_vocab, self.e_vocab)
+        corpus.set_arrays(self.f_ids[self.f_start[lo]:self.f_start[hi]], self.e_ids[self.e_start[lo]:self.e_start[hi]],
+                          self.f_lens[lo:hi], self.e_lens[lo:hi])
+        return corpus
+
+    def swapped(self):
+        # The bitext with French and English exchanged, sharing the arrays
+        corpus = EncodedBitext([], self.e_vocab, self.f_vocab)
+        corpus.set_arrays(self.e_ids, self.f_ids, self.e_lens, self.f_lens)
+        return corpus
+
+    def save(self, filename):
+        np.savez(filename, f_ids=self.f_ids, e_ids=self.e_ids, f_lens=self.f_lens, e_lens=self.e_lens,
+                 f_words=np.array(sorted(self.f_vocab, key=self.f_vocab.get), dtype=str),
+                 e_words=np.array(sorted(self.e_vocab, key=self.e_vocab.get), dtype=str))
+
+    @classmethod
+    def load(cls, filename):
+        arrays = np.load(filename)
+        corpus = cls([])
+        corpus.f_vocab = {w: k for (k, w) in enumerate(arrays["f_words"].tolist())}
+        corpus.e_vocab = {w: k for (k, w) in enumerate(arrays["e_words"].tolist())}
+        corpus.set_arrays(arrays["f_ids"], arrays["e_ids"], arrays["f_lens"], arrays["e_lens"])
+        return corpus
+
+
+def encode_bitext(f_data, e_data, num_sents=None, stem=False, cache_dir=None):
+    # EncodedBitext of read_bitext(...). With cache_dir, the result is kept
+    # there and reused while the files and options stay the same.
+    if cache_dir is None:
+        return EncodedBitext(read_bitext(f_data, e_data, num_sents, stem))
+    key = hashlib.sha1()
+    for filename in (f_data, e_data):
+        info = os.stat(filename)
+        key.update(("%s %d %d\n" % (os.path.abspath(filename), info.st_size, info.st_mtime_ns)).encode("utf-8"))
+    key.update(("%s %s\n" % (num_sents, stem)).encode("utf-8"))
+    cached = os.path.join(cache_dir, "bitext-%s.npz" % key.hexdigest())
+    if os.path.exists(cached):
+        return EncodedBitext.load(cached)
+    corpus = EncodedBitext(read_bitext(f_data, e_data, num_sents, stem))
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = cached + ".%d.tmp.npz" % os.getpid()
+    corpus.save(partial)
+    os.replace(partial, cached)
+    return corpus
@@ -1,17 +1,12 @@
 #!/usr/bin/env python
+import json
 import optparse
+import multiprocessing
+import os
 import sys
-import string
-import nltk
 import numpy as np
-from nltk.stem import PorterStemmer
-from nltk.stem import WordNetLemmatizer
 from collections import defaultdict
-nltk.download("punkt")
-nltk.download("wordnet")
-
-e_stemmer = PorterStemmer()
-f_stemmer = nltk.stem.SnowballStemmer("french")
+from corpus import encode_bitext, read_bitext
 
 def train_model_one(bitext, iters):
     probs = defaultdict(lambda : 1/len(bitext))
@@ -33,66 +28,545 @@ def train_model_one(bitext, iters):
     return probs
 
 
+# Integer-indexed engine. Sentences are stored as flat arrays of word ids (see
+# corpus.EncodedBitext) and EM runs over the distinct (f, e) pairs that
+# co-occur in the bitext, one shard of consecutive sentences at a time.
+SHARD_PAIRS = 1 << 18 # (French, English) position pairs per shard
+
+class Cooccurrences:
+    def __init__(self, corpus, shard_pairs=SHARD_PAIRS):
+        self.corpus = corpus
+        n_e = max(len(corpus.e_vocab), 1)
+        shards, keys = [], []
+        for lo, hi in corpus.shards(shard_pairs):
+            sent, i, j = corpus.pairs(lo, hi)
+            f_ids = corpus.f_ids[corpus.f_start[lo:hi][sent] + i]
+            e_ids = corpus.e_ids[corpus.e_start[lo:hi][sent] + j]
+            shards.append((lo, hi))
+            keys.append(f_ids * n_e + e_ids)
+        # Sorted keys f * |E| + e of every distinct co-occurring pair
+        self.keys = np.unique(np.concatenate([np.unique(k) for k in keys] + [np.zeros(0, np.int64)]))
+        self.f = self.keys // n_e
+        self.e = self.keys % n_e
+        # For each shard, the distinct pairs it contains as indices into keys,
+        # and the index into those of each of its position pairs
+        self.shards = []
+        for (lo, hi), k in zip(shards, keys):
+            (shard_keys, local) = np.unique(k, return_inverse=True)
+            self.shards.append((lo, hi, np.searchsorted(self.keys, shard_keys), local.astype(np.int32)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, lo, hi):
+        # Per position pair: the French token it belongs to (counted from the
+        # first French token of sentence lo) and its English position j
+        sent, i, j = self.corpus.pairs(lo, hi)
+        return self.corpus.f_start[lo:hi][sent] - self.corpus.f_start[lo] + i, j
+
+
+class DistortionTable:
+    # q(i | j, f_len, e_len) for the (f_len, e_len) length pairs that occur in
+    # the bitext, one contiguous f_len x e_len block per pair in a flat array
+    def __init__(self, length_pairs, probs=None):
+        self.offsets = {}
+        size = 0
+        for (f_len, e_len) in sorted(set((int(f_len), int(e_len)) for (f_len, e_len) in length_pairs)):
+            self.offsets[(f_len, e_len)] = size
+            size += f_len * e_len
+        self.probs = np.zeros(size)
+        # Every entry's (f_len, e_len, j) column, the unit q is normalized over
+        self.column = np.zeros(size, dtype=np.int64)
+        n_columns = 0
+        for (f_len, e_len), offset in self.offsets.items():
+            self.column[offset:offset + f_len*e_len] = n_columns + np.tile(np.arange(e_len), f_len)
+            self.probs[offset:offset + f_len*e_len] = 1/(f_len + 1)
+            n_columns += e_len
+        if probs is not None:
+            self.probs = probs
+
+    def __len__(self):
+        return len(self.probs)
+
+    def __getitem__(self, key):
+        (i, j, f_len, e_len) = key
+        offset = self.offsets.get((f_len, e_len))
+        if offset is None or not (0 <= i < f_len and 0 <= j < e_len):
+            return 0.0
+        return self.probs[offset + i*e_len + j]
+
+    def block(self, f_len, e_len, values=None):
+        # f_len x e_len view of the probabilities, or of another array laid out like them
+        offset = self.offsets[(f_len, e_len)]
+        values = self.probs if values is None else values
+        return values[offset:offset + f_len*e_len].reshape(f_len, e_len)
+
+    def offsets_of(self, f_lens, e_lens):
+        # Block offset for each sentence's lengths, -1 for lengths not in the table
+        return np.array([self.offsets.get((f_len, e_len), -1) for (f_len, e_len) in zip(f_lens.tolist(), e_lens.tolist())], dtype=np.int64)
+
+    def lookup(self, f_lens, e_lens, sent, i, j):
+        # q of position pairs (i, j) of sentences with the given lengths. For
+        # lengths the table has not seen, q is uniform as it is before training.
+        offsets = self.offsets_of(f_lens, e_lens)[sent]
+        index = np.clip(offsets + i * e_lens[sent] + j, 0, max(len(self.probs) - 1, 0))
+        found = self.probs[index] if len(self.probs) else 0.0
+        return np.where(offsets >= 0, found, 1/(f_lens[sent] + 1))
+
+    def extended(self, length_pairs, values):
+        # A table that also covers the given length pairs, keeping the current
+        # probabilities, and values laid out for it (zero in new blocks)
+        table = DistortionTable(list(self.offsets) + [(int(f_len), int(e_len)) for (f_len, e_len) in length_pairs])
+        extended = np.zeros(len(table))
+        for ((f_len, e_len), offset) in self.offsets.items():
+            size = f_len * e_len
+            table.probs[table.offsets[(f_len, e_len)]:][:size] = self.probs[offset:offset + size]
+            extended[table.offsets[(f_len, e_len)]:][:size] = values[offset:offset + size]
+        return table, extended
+
+    def normalize(self, q_count):
+        q_total = np.bincount(self.column, weights=q_count)
+        self.probs = q_count / q_total[self.column]
+
+
+# Partial expected counts of one shard, as (indices, values) into each of the
+# count arrays being summed
+def model_one_counts(cooc, k, probs):
+    (lo, hi, pair_keys, pair_idx) = cooc.shards[k]
+    row, _ = cooc.rows(lo, hi)
+    p = probs[pair_keys][pair_idx]
+    norm_z = np.bincount(row, weights=p)
+    fe_count = np.bincount(pair_idx, weights=p / norm_z[row], minlength=len(pair_keys)) # Expected Count
+    return ((pair_keys, fe_count),)
+
+
+def model_two_counts(cooc, k, t_probs, q, q_shards):
+    (lo, hi, pair_keys, pair_idx) = cooc.shards[k]
+    (q_keys, q_idx) = q_shards[k]
+    corpus = cooc.corpus
+    sent, _, j = corpus.pairs(lo, hi)
+    col = corpus.e_start[lo:hi][sent] - corpus.e_start[lo] + j
+    p = t_probs[pair_keys][pair_idx] * q.probs[q_keys][q_idx]
+    e_total = np.bincount(col, weights=p) # Normalize
+    c = p / e_total[col]
+    fe_count = np.bincount(pair_idx, weights=c, minlength=len(pair_keys))
+    q_count = np.bincount(q_idx, weights=c, minlength=len(q_keys))
+    return ((pair_keys, fe_count), (q_keys, q_count))
+
+
+# E-step inputs of the current iteration, inherited by forked workers
+_e_step = None
+
+def _shard_counts(k):
+    (counts, cooc, tables) = _e_step
+    return counts(cooc, k, *tables)
+
+def e_step(counts, cooc, tables, sizes, workers=1):
+    # Sums counts(cooc, k, *tables) over the shards k in shard order, so the
+    # totals do not depend on the number of workers. Totals such as count_e
+    # and q_total are taken from the summed counts in the M-step.
+    global _e_step
+    _e_step = (counts, cooc, tables)
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers)
+        partials = pool.imap(_shard_counts, range(len(cooc.shards)))
+    else:
+        pool = None
+        partials = map(_shard_counts, range(len(cooc.shards)))
+    totals = tuple(np.zeros(size) for size in sizes)
+    for partial in partials:
+        for (total, (keys, values)) in zip(totals, partial):
+            total[keys] += values
+    if pool is not None:
+        pool.close()
+        pool.join()
+    _e_step = None
+    return totals
+
+
+def train_model_one_vectorized(cooc, iters, workers=1, stats=None):
+    # Same updates as train_model_one, including expected counts that keep
+    # accumulating across iterations, with t(f|e) indexed like cooc.keys.
+    # A stats dict receives the counts per iteration t is normalized from.
+    probs = np.full(len(cooc), 1/len(cooc.corpus))
+    fe_count = np.zeros(len(cooc))
+    n_e = len(cooc.corpus.e_vocab)
+
+    for i in range(iters):
+        fe_count += e_step(model_one_counts, cooc, (probs,), [len(cooc)], workers)[0]
+        count_e = np.bincount(cooc.e, weights=fe_count, minlength=n_e)
+        probs = fe_count / count_e[cooc.e] # Normalize
+    if stats is not None:
+        stats["t"] = fe_count / max(iters, 1)
+    return probs
+
+
+# Alignment decoding. For each shard, the score of every (i, j) position pair
+# is gathered from t (and q for Model 2) in one pass. Each French word takes
+# its best-scoring English position. Alternatively, links can be chosen by
+# their posterior under the model: normalized per French word for Model 1 and
+# per English word for Model 2, as in the E-steps.
+def alignment_scores(cooc, shard, t_probs, q=None):
+    (lo, hi, pair_keys, pair_idx) = shard
+    scores = t_probs[pair_keys][pair_idx]
+    if q is not None:
+        corpus = cooc.corpus
+        sent, i, j = corpus.pairs(lo, hi)
+        scores = scores * q.lookup(corpus.f_lens[lo:hi], corpus.e_lens[lo:hi], sent, i, j)
+    return scores
+
+def best_alignment(cooc, t_probs, q=None):
+    # Best English position of every French token in the corpus
+    corpus = cooc.corpus
+    best_j = np.zeros(len(corpus.f_ids), dtype=np.int64)
+    for shard in cooc.shards:
+        (lo, hi, _, _) = shard
+        row, j = cooc.rows(lo, hi)
+        if len(row):
+            p = alignment_scores(cooc, shard, t_probs, q)
+            starts = np.flatnonzero(np.diff(row, prepend=-1))
+            row_max = np.maximum.reduceat(p, starts)
+            first_j = np.minimum.reduceat(np.where(p == np.repeat(row_max, np.diff(starts, append=len(p))), j, len(p)), starts)
+            best_j[corpus.f_start[lo] + row[starts]] = first_j
+    return best_j
+
+def posterior_alignment(cooc, t_probs, q, threshold):
+    # Yields a (lo, hi, sent, i, j) shard of position pairs whose posterior is
+    # at least threshold
+    corpus = cooc.corpus
+    for shard in cooc.shards:
+        (lo, hi, _, _) = shard
+        sent, i, j = corpus.pairs(lo, hi)
+        p = alignment_scores(cooc, shard, t_probs, q)
+        if q is None:
+            group = corpus.f_start[lo:hi][sent] - corpus.f_start[lo] + i
+        else:
+            group = corpus.e_start[lo:hi][sent] - corpus.e_start[lo] + j
+        total = np.bincount(group, weights=p)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            linked = p / total[group] >= threshold
+        yield (lo, hi, sent[linked], i[linked], j[linked])
+
+def align_vectorized(cooc, t_probs, q=None, posterior=None):
+    # Yields the (i, j) links of each sentence
+    corpus = cooc.corpus
+    if posterior is None:
+        best_j = best_alignment(cooc, t_probs, q)
+        for k in range(len(corpus)):
+            yield enumerate(best_j[corpus.f_start[k]:corpus.f_start[k+1]].tolist())
+        return
+    for (lo, hi, sent, i, j) in posterior_alignment(cooc, t_probs, q, posterior):
+        yield from sentence_links(hi - lo, sent, i, j)
+
+def sentence_links(n_sents, sent, i, j):
+    # Splits the links of a shard, ordered by sentence, into one zip per sentence
+    counts = np.bincount(sent, minlength=n_sents).tolist()
+    (i, j) = (i.tolist(), j.tolist())
+    k = 0
+    for n in counts:
+        yield zip(i[k:k+n], j[k:k+n])
+        k += n
+
+
+# Symmetrization. Each direction is trained in its own process, and the two
+# directional alignments are merged on the flat (i, j) position pairs of a
+# shard of sentences at once. In every grow round all eligible neighbours are
+# added together, rather than one at a time in a fixed scan order.
+NEIGHBOURS = [(-1,0), (0,-1), (1,0), (0,1), (-1,-1), (-1,1), (1,-1), (1,1)]
+
+def train_and_align(corpus, model, workers=1):
+    # Best English position of every French token, for the whole corpus
+    cooc = Cooccurrences(corpus)
+    if model == "one":
+        probs = train_model_one_vectorized(cooc, 10, workers)
+        q = None
+    else:
+        probs, q = train_model_two_vectorized(cooc, 5, workers)
+    return best_alignment(cooc, probs, q)
+
+def _train_direction(conn, corpus, model, workers):
+    conn.send(train_and_align(corpus, model, workers))
+    conn.close()
+
+def train_directions(corpus, model, workers=1):
+    # French->English and English->French alignments, trained concurrently
+    context = multiprocessing.get_context("fork")
+    running = []
+    for direction in (corpus, corpus.swapped()):
+        (receiver, sender) = context.Pipe(duplex=False)
+        process = context.Process(target=_train_direction, args=(sender, direction, model, workers))
+        process.start()
+        running.append((process, receiver))
+    best = [receiver.recv() for (_, receiver) in running]
+    for (process, _) in running:
+        process.join()
+    return best
+
+def symmetrize(corpus, fe_best, ef_best, method):
+    # Yields the (i, j) links of each sentence, merged with "intersect",
+    # "union" or "grow-diag-final"
+    for lo, hi in corpus.shards(SHARD_PAIRS):
+        sent, i, j = corpus.pairs(lo, hi)
+        f_tok = corpus.f_start[lo:hi][sent] + i - corpus.f_start[lo]
+        e_tok = corpus.e_start[lo:hi][sent] + j - corpus.e_start[lo]
+        fe = fe_best[corpus.f_start[lo] + f_tok] == j
+        ef = ef_best[corpus.e_start[lo] + e_tok] == i
+        if method == "intersect":
+            links = fe & ef
+        elif method == "union":
+            links = fe | ef
+        else:
+            links = grow_diag_final(corpus, lo, hi, sent, i, j, f_tok, e_tok, fe, ef)
+        yield from sentence_links(hi - lo, sent[links], i[links], j[links])
+
+def grow_diag_final(corpus, lo, hi, sent, i, j, f_tok, e_tok, fe, ef):
+    (f_lens, e_lens) = (corpus.f_lens[lo:hi][sent], corpus.e_lens[lo:hi][sent])
+    (n_f, n_e) = (corpus.f_start[hi] - corpus.f_start[lo], corpus.e_start[hi] - corpus.e_start[lo])
+    union = fe | ef
+    links = fe & ef
+    def unaligned():
+        # Whether the French and English word of each pair is still unaligned
+        return (np.bincount(f_tok[links], minlength=n_f) == 0)[f_tok], (np.bincount(e_tok[links], minlength=n_e) == 0)[e_tok]
+    neighbours = []
+    for (di, dj) in NEIGHBOURS:
+        valid = np.flatnonzero((i + di >= 0) & (i + di < f_lens) & (j + dj >= 0) & (j + dj < e_lens))
+        neighbours.append((valid, valid + di * e_lens[valid] + dj))
+    while True: # grow-diag
+        (f_free, e_free) = unaligned()
+        near = np.zeros(len(links), dtype=bool)
+        for (point, neighbour) in neighbours:
+            near[point] |= links[neighbour]
+        grow = union & ~links & near & (f_free | e_free)
+        if not grow.any():
+            break
+        links |= grow
+    for direction in (fe, ef): # final
+        (f_free, e_free) = unaligned()
+        links |= direction & (f_free | e_free)
+    return links
+
+
 def train_model_two(bitext, iters):
-    e_total = defaultdict(lambda: 0.0)
     t_probs = train_model_one(bitext, 5)
+    q = DistortionTable((len(f_sent), len(e_sent)) for (f_sent, e_sent) in bitext)
 
-    en_vocab = []
-    fr_vocab = []
-    for (f_sent, e_sent) in bitext:
-        en_vocab.extend(e_sent)
-        fr_vocab.extend(f_sent)
-
-    en_vocab = set(en_vocab)
-    fr_vocab = set(fr_vocab)
-
-    max_e = max([len(e_sent) for _, e_sent in bitext])
-    max_f = max([len(f_sent) for f_sent, _ in bitext])
-
-    q = np.zeros((max_f+1, max_e+1, max_f+1, max_e+1), dtype=float)
-    for (f_sent, e_sent) in bitext:
-        f_len = len(f_sent)
-        e_len = len(e_sent)
-        for i in range(f_len):
-            for j in range(e_len):
-                q[i,j,f_len,e_len] = 1/(f_len + 1)
- 
     for i in range(iters):
         f_total = defaultdict(float)
         fe_count = defaultdict(float)
-        q_count = np.zeros((max_f+1, max_e+1, max_f+1, max_e+1), dtype=float)
-        q_total = np.zeros((max_e+1, max_f+1, max_e+1), dtype=float)
+        q_count = np.zeros(len(q))
         for (f_sent, e_sent) in bitext:
             f_len = len(f_sent)
             e_len = len(e_sent)
+            q_block = q.block(f_len, e_len)
+            count_block = q.block(f_len, e_len, q_count)
             for (j, e_j) in enumerate(e_sent):
+                e_total = 0.0
                 for (i, f_i) in enumerate(f_sent):
-                    e_total[e_j] += t_probs[(f_i,e_j)] * q[i,j,f_len,e_len] # Normalize
-            
-            for (j, e_j) in enumerate(e_sent):
+                    e_total += t_probs[(f_i,e_j)] * q_block[i,j] # Normalize
+
                 for (i, f_i) in enumerate(f_sent):
-                    c = t_probs[(f_i,e_j)] * q[i,j,f_len,e_len] / e_total[e_j]
-                    q_count[i,j,f_len,e_len] += c
-                    q_total[j,f_len,e_len] += c
+                    c = t_probs[(f_i,e_j)] * q_block[i,j] / e_total
+                    count_block[i,j] += c
                     fe_count[(f_i,e_j)] += c
                     f_total[f_i] += c
 
-        q = defaultdict(lambda: 0.0)
         t_probs = defaultdict(lambda: 0.0)
+        for (f, e) in fe_count:
+            t_probs[(f,e)] = fe_count[(f,e)] / f_total[f]
+        q.normalize(q_count)
 
-        for f in fr_vocab:
-            for e in en_vocab:
-                t_probs[(f,e)] = fe_count[(f,e)] / f_total[f]
-                    
-        for (f_sent, e_sent) in bitext:
-            f_len = len(f_sent)
-            e_len = len(e_sent)
-            for (j, e_j) in enumerate(e_sent):
-                for (i, f_i) in enumerate(f_sent):
-                    q[i,j,f_len,e_len] = q_count[i,j,f_len,e_len] / q_total[j,f_len,e_len]
+    return t_probs, q
+
+
+def distortion_shards(cooc, q):
+    # For each shard, the distinct q entries it uses and the index into those
+    # of each of its position pairs
+    corpus = cooc.corpus
+    q_start = q.offsets_of(corpus.f_lens, corpus.e_lens)
+    q_shards = []
+    for lo, hi, _, _ in cooc.shards:
+        sent, i, j = corpus.pairs(lo, hi)
+        (q_keys, q_idx) = np.unique(q_start[lo:hi][sent] + i * corpus.e_lens[lo:hi][sent] + j, return_inverse=True)
+        q_shards.append((q_keys, q_idx.astype(np.int32)))
+    return q_shards
+
+def train_model_two_vectorized(cooc, iters, workers=1, stats=None):
+    # train_model_two with t(e|f) indexed like cooc.keys. A stats dict
+    # receives the last iteration's counts.
+    corpus = cooc.corpus
+    t_probs = train_model_one_vectorized(cooc, 5, workers)
+    q = DistortionTable(zip(corpus.f_lens, corpus.e_lens))
+    q_shards = distortion_shards(cooc, q)
+    n_f = len(corpus.f_vocab)
+
+    for it in range(iters):
+        (fe_count, q_count) = e_step(model_two_counts, cooc, (t_probs, q, q_shards), [len(cooc), len(q)], workers)
+        f_total = np.bincount(cooc.f, weights=fe_count, minlength=n_f)
+        t_probs = fe_count / f_total[cooc.f]
+        q.normalize(q_count)
+        if stats is not None:
+            stats["t"] = fe_count
+            stats["q"] = q_count
 
     return t_probs, q
 
+# Learned tables saved to a single binary file: a magic line, a JSON header
+# giving the model, vocabulary sizes and the layout of each array, then the
+# arrays themselves, which are memory-mapped when the file is loaded.
+#   f_vocab, e_vocab  words in id order, newline separated
+#   t_keys, t_probs   sorted f * |E| + e keys of t and their probabilities
+#   q_lengths, q_probs  sorted (f_len, e_len) pairs and the DistortionTable
+#                       blocks laid out in that order (Model 2 only)
+#   t_counts, q_counts  expected counts t and q were normalized from, for
+#                       updating the tables with online EM (optional)
+TABLES_MAGIC = b"IBMTABLES 1\n"
+
+class Tables:
+    def __init__(self, model, f_vocab, e_vocab, t_keys, t_probs, q=None, stats=None, n_sents=0, updates=0):
+        self.model = model
+        self.f_vocab = f_vocab
+        self.e_vocab = e_vocab
+        self.t_keys = t_keys
+        self.t_probs = t_probs
+        self.q = q
+        self.stats = stats # {"t": t_counts[, "q": q_counts]} or None
+        self.n_sents = n_sents # sentence pairs the counts are scaled to
+        self.updates = updates # online EM steps taken so far
+
+    @classmethod
+    def from_training(cls, cooc, t_probs, q=None, stats=None, batch_size=None):
+        # With batch_size, the training data counts as the online EM steps it
+        # would have taken in batches of that size
+        updates = -(-len(cooc.corpus) // batch_size) if batch_size else 0
+        return cls("two" if q is not None else "one", cooc.corpus.f_vocab, cooc.corpus.e_vocab, cooc.keys, t_probs, q,
+                   stats, len(cooc.corpus), updates)
+
+    def save(self, filename):
+        arrays = {
+            "f_vocab": np.frombuffer("\n".join(sorted(self.f_vocab, key=self.f_vocab.get)).encode("utf-8"), dtype=np.uint8),
+            "e_vocab": np.frombuffer("\n".join(sorted(self.e_vocab, key=self.e_vocab.get)).encode("utf-8"), dtype=np.uint8),
+            "t_keys": np.asarray(self.t_keys, dtype=np.int64),
+            "t_probs": np.asarray(self.t_probs, dtype=np.float32),
+        }
+        if self.q is not None:
+            arrays["q_lengths"] = np.array(sorted(self.q.offsets), dtype=np.int64).reshape(-1, 2)
+            arrays["q_probs"] = np.asarray(self.q.probs, dtype=np.float32)
+        for (name, counts) in (self.stats or {}).items():
+            arrays[name + "_counts"] = np.asarray(counts, dtype=np.float64)
+        layout = {}
+        offset = 0
+        for (name, array) in arrays.items():
+            offset += -offset % 64
+            layout[name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+            offset += array.nbytes
+        header = json.dumps({"model": self.model, "f_size": len(self.f_vocab), "e_size": len(self.e_vocab),
+                             "n_sents": self.n_sents, "updates": self.updates, "arrays": layout}).encode("utf-8") + b"\n"
+        start = len(TABLES_MAGIC) + len(header)
+        start += -start % 64 # arrays are 64-byte aligned
+        # Written next to the target and renamed, so that a file being
+        # memory-mapped (e.g. the one being updated) is never truncated
+        partial = "%s.%d.tmp" % (filename, os.getpid())
+        with open(partial, "wb") as out:
+            out.write(TABLES_MAGIC)
+            out.write(header)
+            for (name, array) in arrays.items():
+                out.seek(start + layout[name]["offset"])
+                out.write(array.tobytes())
+        os.replace(partial, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            if f.readline() != TABLES_MAGIC:
+                raise ValueError("%s is not a saved IBM model table file" % filename)
+            header = f.readline()
+        start = len(TABLES_MAGIC) + len(header)
+        start += -start % 64
+        info = json.loads(header)
+        data = np.memmap(filename, dtype=np.uint8, mode="r")
+        arrays = {}
+        for (name, layout) in info["arrays"].items():
+            dtype = np.dtype(layout["dtype"])
+            count = int(np.prod(layout["shape"], dtype=np.int64))
+            arrays[name] = data[start + layout["offset"]:start + layout["offset"] + count * dtype.itemsize].view(dtype).reshape(layout["shape"])
+        f_words = arrays["f_vocab"].tobytes().decode("utf-8").split("\n") if info["f_size"] else []
+        e_words = arrays["e_vocab"].tobytes().decode("utf-8").split("\n") if info["e_size"] else []
+        q = None
+        if "q_lengths" in arrays:
+            q = DistortionTable(map(tuple, arrays["q_lengths"].tolist()), arrays["q_probs"])
+        stats = {name: arrays[name + "_counts"] for name in ("t", "q") if name + "_counts" in arrays} or None
+        return cls(info["model"], {w: k for (k, w) in enumerate(f_words)}, {e: k for (k, e) in enumerate(e_words)},
+                   arrays["t_keys"], arrays["t_probs"], q, stats, info.get("n_sents", 0), info.get("updates", 0))
+
+    def t_for(self, cooc):
+        # t for each of cooc.keys, 0 for pairs the tables have never seen.
+        # cooc must be built over the tables' vocabularies (extended by any
+        # new words).
+        n_f, n_e = len(self.f_vocab), len(self.e_vocab)
+        if len(self.t_keys) == 0:
+            return np.zeros(len(cooc))
+        keys = cooc.f * n_e + cooc.e
+        idx = np.minimum(np.searchsorted(self.t_keys, keys), len(self.t_keys) - 1)
+        found = (cooc.f < n_f) & (cooc.e < n_e) & (self.t_keys[idx] == keys)
+        return np.where(found, self.t_probs[idx], 0.0)
+
+# Online (stepwise) EM. New sentence pairs are processed in mini-batches. The
+# expected counts of each batch, scaled up to the size of the data the saved
+# counts describe, are interpolated into those counts with step size
+# (updates + 2) ** -alpha, and t and q are normalized from the result.
+def update_tables(tables, corpus, batch_size=1000, alpha=0.7, workers=1):
+    if tables.stats is None:
+        raise ValueError("the tables were saved without expected counts")
+    corpus = corpus.with_vocab(tables.f_vocab, tables.e_vocab)
+    (n_f, n_e) = (len(corpus.f_vocab), len(corpus.e_vocab))
+    # Re-key t for the extended English vocabulary; the key order is unchanged
+    old_n_e = max(len(tables.e_vocab), 1)
+    keys = (tables.t_keys // old_n_e) * n_e + tables.t_keys % old_n_e
+    (t_probs, t_counts) = (np.array(tables.t_probs, dtype=np.float64), np.array(tables.stats["t"]))
+    (q, q_counts) = (tables.q, np.array(tables.stats["q"]) if tables.q is not None else None)
+    n_sents = max(tables.n_sents, 1)
+
+    for lo in range(0, len(corpus), batch_size):
+        batch = corpus.sentences(lo, min(lo + batch_size, len(corpus)))
+        cooc = Cooccurrences(batch)
+        # New (f, e) pairs enter with zero counts and uniform t
+        merged = np.union1d(keys, cooc.keys)
+        at = np.searchsorted(merged, keys)
+        (t_probs, t_counts) = (scatter(t_probs, at, len(merged), 1/(n_f if q is None else n_e)), scatter(t_counts, at, len(merged)))
+        keys = merged
+        pair = np.searchsorted(keys, cooc.keys)
+        if q is None:
+            (fe_count,) = e_step(model_one_counts, cooc, (t_probs[pair],), [len(cooc)], workers)
+        else:
+            (q, q_counts) = q.extended(zip(batch.f_lens, batch.e_lens), q_counts)
+            (fe_count, q_count) = e_step(model_two_counts, cooc, (t_probs[pair], q, distortion_shards(cooc, q)), [len(cooc), len(q)], workers)
+        eta = (tables.updates + 2) ** -alpha
+        scale = n_sents / len(batch)
+        t_counts *= 1 - eta
+        t_counts[pair] += eta * scale * fe_count
+        if q is None:
+            (f, e) = (keys // n_e, keys % n_e)
+            count_e = np.bincount(e, weights=t_counts, minlength=n_e)
+            t_probs = t_counts / count_e[e]
+        else:
+            q_counts = (1 - eta) * q_counts + eta * scale * q_count
+            f = keys // n_e
+            f_total = np.bincount(f, weights=t_counts, minlength=n_f)
+            t_probs = t_counts / f_total[f]
+            q.normalize(q_counts)
+        tables.updates += 1
+
+    tables.f_vocab = corpus.f_vocab
+    tables.e_vocab = corpus.e_vocab
+    (tables.t_keys, tables.t_probs, tables.q) = (keys, t_probs, q)
+    tables.stats = {"t": t_counts} if q is None else {"t": t_counts, "q": q_counts}
+    return tables
+
+def scatter(values, at, size, fill=0.0):
+    result = np.full(size, fill)
+    result[at] = values
+    return result
+
 if __name__ == "__main__":
     # Read in command line arguments
     optparser = optparse.OptionParser()
@@ -102,32 +576,79 @@ if __name__ == "__main__":
     optparser.add_option("-n", "--num_sentences", dest="num_sents", default=100000000000, type="int", help="Number of sentences to use for training and alignment")
     optparser.add_option("-m", "--model", dest="model", default="two", help="IBM Model to run (default = two)")
     optparser.add_option("-s", "--stemming", action="store_true", dest="stem", default=False)
+    optparser.add_option("-x", "--engine", dest="engine", default="numpy", type="choice", choices=["dict", "numpy"], help="EM implementation: dict or numpy (default = numpy)")
+    optparser.add_option("-j", "--workers", dest="workers", default=1, type="int", help="Worker processes for the numpy engine's E-step (default = 1)")
+    optparser.add_option("-o", "--save", dest="save", default=None, help="Save the trained tables to this file")
+    optparser.add_option("-l", "--load", dest="load", default=None, help="Align with tables saved by --save instead of training")
+    optparser.add_option("-u", "--update", dest="update", default=None, help="Update tables saved by --save with online EM over the -d bitext, then align it")
+    optparser.add_option("--batch-size", dest="batch_size", default=1000, type="int", help="Sentence pairs per online EM step (default = 1000)")
+    optparser.add_option("--step-decay", dest="step_decay", default=0.7, type="float", help="Online EM step size is (steps + 2) ** -decay (default = 0.7)")
+    optparser.add_option("-y", "--symmetrize", dest="symmetrize", default=None, type="choice", choices=["intersect", "union", "grow-diag-final"], help="Train both directions and merge them: intersect, union or grow-diag-final")
+    optparser.add_option("-p", "--posterior", dest="posterior", default=None, type="float", help="Output every link whose alignment posterior is at least this, instead of the best link per French word")
+    optparser.add_option("-c", "--cache", dest="cache", default=None, help="Directory in which to cache the encoded bitext between runs")
 
     (opts, _) = optparser.parse_args()
     f_data = "%s.%s" % (opts.train, opts.french)
     e_data = "%s.%s" % (opts.train, opts.english)
 
-    sys.stderr.write("Training with IBM Model 1...")
-
-    bitext = []
-    if opts.stem:
-        with open(f_data) as f_file, open(e_data) as e_file:
-            for f_sentence, e_sentence in zip(f_file, e_file):
-                f_sentence = f_sentence.strip()
-                e_sentence = e_sentence.strip()
-                f_tokens =f_sentence.lower().split()
-                e_tokens= e_sentence.lower().split()
-                f_tokens = [f_stemmer.stem(token) for token in f_tokens]
-                e_tokens =  [e_stemmer.stem(token) for token in e_tokens]
-                bitext.append([f_tokens, e_tokens])
+    if opts.update:
+        sys.stderr.write("Updating %s with online EM...\n" % opts.update)
     else:
-        bitext = [[sentence.strip().split() for sentence in pair] for pair in zip(open(f_data), open(e_data))]
+        sys.stderr.write("Aligning with %s...\n" % opts.load if opts.load else "Training with IBM Model 1...")
 
     # Use bitext for training and alignment
-    bitext = bitext[:opts.num_sents]
+    if opts.load or opts.update or opts.engine == "numpy":
+        bitext = encode_bitext(f_data, e_data, opts.num_sents, opts.stem, opts.cache)
+    else:
+        bitext = list(read_bitext(f_data, e_data, opts.num_sents, opts.stem))
 
     probs = defaultdict(float)
 
+    if opts.posterior is not None and (opts.symmetrize or not (opts.load or opts.update or opts.engine == "numpy")):
+        optparser.error("--posterior requires the numpy engine or --load, and no --symmetrize")
+    if opts.symmetrize:
+        if opts.engine != "numpy" or opts.load or opts.update or opts.save:
+            optparser.error("--symmetrize trains with the numpy engine and does not load or save tables")
+        (fe_best, ef_best) = train_directions(bitext, opts.model, opts.workers)
+
+        # Alignment
+        for links in symmetrize(bitext, fe_best, ef_best, opts.symmetrize):
+            for (i, j) in links:
+                sys.stdout.write("%i-%i " % (i,j))
+            sys.stdout.write("\n")
+        sys.exit(0)
+
+    if opts.update:
+        tables = update_tables(Tables.load(opts.update), bitext, opts.batch_size, opts.step_decay, opts.workers)
+        tables.save(opts.save or opts.update)
+    elif opts.load:
+        tables = Tables.load(opts.load)
+    if opts.load or opts.update:
+        cooc = Cooccurrences(bitext.with_vocab(tables.f_vocab, tables.e_vocab))
+        probs = tables.t_for(cooc)
+        q = tables.q
+    elif opts.engine == "numpy":
+        cooc = Cooccurrences(bitext)
+        q = None
+        stats = {}
+        if opts.model == "one":
+            probs = train_model_one_vectorized(cooc, 10, opts.workers, stats)
+        else:
+            probs, q = train_model_two_vectorized(cooc, 5, opts.workers, stats)
+        if opts.save:
+            Tables.from_training(cooc, probs, q, stats, opts.batch_size).save(opts.save)
+    elif opts.save:
+        optparser.error("saving tables requires the numpy engine")
+
+    if opts.load or opts.update or opts.engine == "numpy":
+        # Alignment
+        for links in align_vectorized(cooc, probs, q, opts.posterior):
+            for (i, j) in links:
+                sys.stdout.write("%i-%i " % (i,j))
+            sys.stdout.write("\n")
+        sys.exit(0)
+
+    q = None
     if opts.model == "one":
         probs = train_model_one(bitext, 10)
     elif opts.model == "two":
@@ -141,8 +662,9 @@ if __name__ == "__main__":
             best_prob = 0
             best_j = 0
             for (j, e_j) in enumerate(e):
-                if probs[(f_i,e_j)] > best_prob:
-                    best_prob = probs[(f_i,e_j)]
+                prob = probs[(f_i,e_j)] * (q[i,j,len(f),len(e)] if q is not None else 1.0)
+                if prob > best_prob:
+                    best_prob = prob
                     best_j = j
             sys.stdout.write("%i-%i " % (i,best_j))
         sys.stdout.write("\n")
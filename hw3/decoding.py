@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+# Helpers shared by the decoders
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import sys
+import time
+from collections import namedtuple
+
+# Sentences are independent, so a decoder can translate them in parallel:
+# parallel_map(function, items, jobs) yields function(item) for each item,
+# in order, computed by a pool of jobs processes. The workers are forked
+# after the models are loaded, so they share the model memory copy-on-write
+# and only the items and results are sent between processes; the function
+# itself is inherited, so it can be a closure or a bound method.
+_work = None
+
+def _call(item):
+  return _work(item)
+
+def parallel_map(function, items, jobs=1):
+  global _work
+  if jobs <= 1:
+    for item in items:
+      yield function(item)
+    return
+  _work = function
+  with multiprocessing.get_context("fork").Pool(jobs) as pool:
+    for result in pool.imap(_call, items, chunksize=1):
+      yield result
+
+# A decoding service: serve(function, address, jobs) keeps the loaded models
+# and answers requests until its input ends (stdin) or forever (a socket).
+# A request is a line holding a French sentence; its answer is a line
+# holding function(sentence), written on the same connection in request
+# order as soon as it and the answers before it are done. address is "-"
+# for stdin and stdout, host:port for TCP, or else the path of a Unix
+# socket. An asyncio front end reads the requests of every connection and
+# hands them in batches to jobs forked workers (a thread, for one job): a
+# worker that frees up takes all the requests waiting, up to
+# SERVE_BATCH_SIZE, so that it keeps up under load at no cost in latency.
+SERVE_BATCH_SIZE = 16
+
+def _call_batch(items):
+  results = []
+  for item in items:
+    try:
+      results.append((True, _work(item)))
+    except Exception as e: # answer the rest of the batch regardless
+      results.append((False, "%s: %s" % (type(e).__name__, e)))
+  return results
+
+def serve(function, address="-", jobs=1):
+  global _work
+  _work = function
+  if jobs <= 1:
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+  else:
+    executor = concurrent.futures.ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork"))
+    executor.submit(int).result() # fork the workers now, before asyncio starts any threads
+  with executor:
+    try:
+      asyncio.run(_serve(executor, address, max(jobs, 1)))
+    except KeyboardInterrupt:
+      pass
+
+async def _serve(executor, address, jobs):
+  requests = asyncio.Queue() # (sentence, future of its answer)
+  dispatcher = asyncio.create_task(_dispatch(requests, executor, jobs))
+  try:
+    if address == "-":
+      await _answer(requests, _stdin_lines(), _stdout_write)
+      return
+    (host, _, port) = address.rpartition(":")
+    answer = functools.partial(_answer_stream, requests)
+    if host and port.isdigit():
+      server = await asyncio.start_server(answer, host, int(port))
+    else:
+      server = await asyncio.start_unix_server(answer, address)
+    sys.stderr.write("Serving on %s...\n" % (address,))
+    async with server:
+      await server.serve_forever()
+  finally:
+    dispatcher.cancel()
+
+async def _dispatch(requests, executor, jobs):
+  loop = asyncio.get_running_loop()
+  workers = asyncio.Semaphore(jobs)
+  while True:
+    await workers.acquire()
+    batch = [await requests.get()]
+    while len(batch) < SERVE_BATCH_SIZE and not requests.empty():
+      batch.append(requests.get_nowait())
+    done = loop.run_in_executor(executor, _call_batch, [sentence for (sentence, _) in batch])
+    done.add_done_callback(functools.partial(_finish, batch, workers))
+
+def _finish(batch, workers, done):
+  workers.release()
+  if done.cancelled(): # shutting down
+    return
+  try:
+    results = done.result()
+  except Exception as e: # the worker itself failed
+    results = [(False, "%s: %s" % (type(e).__name__, e))] * len(batch)
+  for ((sentence, future), (ok, answer)) in zip(batch, results):
+    if not ok:
+      sys.stderr.write("Could not translate %s: %s\n" % (sentence, answer))
+      answer = ""
+    if not future.done():
+      future.set_result(answer)
+
+# Queues each request line for the workers, and writes the answers back in
+# request order as they become ready.
+async def _answer(requests, lines, write):
+  loop = asyncio.get_running_loop()
+  answers = asyncio.Queue()
+  async def respond():
+    while True:
+      answer = await answers.get()
+      if answer is None:
+        return
+      await write(await answer)
+  responder = asyncio.create_task(respond())
+  async for line in lines:
+    answer = loop.create_future()
+    requests.put_nowait((line.strip(), answer))
+    answers.put_nowait(answer)
+  answers.put_nowait(None)
+  await responder
+
+async def _stdin_lines():
+  loop = asyncio.get_running_loop()
+  while True:
+    line = await loop.run_in_executor(None, sys.stdin.readline) # stdin may be a file, which asyncio cannot watch
+    if not line:
+      return
+    yield line
+
+async def _stdout_write(answer):
+  sys.stdout.write(answer + "\n")
+  sys.stdout.flush()
+
+async def _answer_stream(requests, reader, writer):
+  async def lines():
+    async for line in reader:
+      yield line.decode("utf-8")
+  async def write(answer):
+    writer.write((answer + "\n").encode("utf-8"))
+    await writer.drain()
+  try:
+    await _answer(requests, lines(), write)
+  except ConnectionError:
+    pass
+  finally:
+    writer.close()
+
+# The translation options of a sentence f, found once before search so that
+# decoders index spans rather than slicing f and looking it up in the TM.
+# options[i][j] lists those of f[i:j] (empty if the TM has none), each with
+# the LM word ids of its English words, for lm.score_ids, and an estimate
+# of its score out of context: its TM logprob plus the LM logprob of its
+# words with no history (state 0). ends[i] lists the j for which f[i:j] has
+# options, shortest first.
+option = namedtuple("option", "phrase, word_ids, estimate")
+
+class TranslationOptions:
+  def __init__(self, f, tm, lm):
+    self.length = len(f)
+    self.options = [[() for _ in range(len(f) + 1)] for _ in range(len(f) + 1)]
+    self.ends = [[] for _ in range(len(f) + 1)]
+    for i in range(len(f)):
+      for j in range(i + 1, len(f) + 1):
+        phrases = tm.get(f[i:j])
+        if phrases:
+          self.options[i][j] = [option(phrase, word_ids, phrase.logprob + lm.score_ids(0, word_ids)[1])
+                                for phrase in phrases for word_ids in [lm.word_ids(phrase.english)]]
+          self.ends[i].append(j)
+
+  def future_costs(self, score=lambda translation: translation.estimate):
+    # costs[i][j] estimates the best logprob of translating f[i:j] on its own:
+    # the best score of one of its options, or of a split of it into two
+    # cheaper parts
+    n = self.length
+    costs = [[-math.inf] * (n + 1) for _ in range(n + 1)]
+    for length in range(1, n + 1):
+      for i in range(n - length + 1):
+        j = i + length
+        row = costs[i]
+        for translation in self.options[i][j]:
+          row[j] = max(row[j], score(translation))
+        for m in range(i + 1, j):
+          row[j] = max(row[j], row[m] + costs[m][j])
+    return costs
+
+# Cube pruning: rather than scoring every extension of every hypothesis
+# with the LM, the candidates for a stack are generated lazily, best first.
+# Each grid pairs a list of rows (hypotheses) with a list of columns (the
+# translation options of one span), both sorted best first, and
+# score(row, column) returns (priority, new_hypothesis). Starting from the
+# top left corner of each grid, cube_prune repeatedly pops the best scored
+# candidate and scores its right and lower neighbours, yielding at most
+# pop_limit candidates; only those and the frontier are ever scored.
+def cube_prune(grids, pop_limit, score):
+  heap = []
+  seen = set()
+  order = itertools.count() # breaks ties between equal priorities
+  def push(g, i, j):
+    (rows, columns) = grids[g]
+    if i < len(rows) and j < len(columns) and (g, i, j) not in seen:
+      seen.add((g, i, j))
+      (priority, item) = score(rows[i], columns[j])
+      heapq.heappush(heap, (-priority, next(order), g, i, j, item))
+  for g in range(len(grids)):
+    push(g, 0, 0)
+  for _ in range(pop_limit):
+    if not heap:
+      break
+    (_, _, g, i, j, item) = heapq.heappop(heap)
+    yield item
+    push(g, i + 1, j)
+    push(g, i, j + 1)
+
+# A stack of hypotheses, recombined on a key and bounded in size. add(key,
+# h) keeps only the best (by logprob) hypothesis added for each key, so a
+# hypothesis is dropped if a better one with its key was pruned; once
+# the stack holds more than capacity hypotheses the one with the worst
+# score(h) is evicted, using a min-heap. With a threshold, hypotheses
+# scoring more than threshold below the best one seen are pruned too.
+# best() returns the survivors, best first, for expansion; created counts
+# the hypotheses added, and pruned and recombined those dropped each way.
+# Given an arcs dict (shared by a sentence's stacks), hypotheses recombined
+# into a surviving one are kept in arcs[id(survivor)], as alternative
+# derivations of it for n-best lists and lattices.
+class HypothesisStack:
+  def __init__(self, capacity, threshold=None, score=lambda h: h.logprob, arcs=None):
+    self.capacity = capacity
+    self.arcs = arcs
+    self.threshold = threshold
+    self.score = score
+    self.hypotheses = {} # key -> hypothesis
+    self.logprobs = {} # key -> best logprob added, even if since pruned
+    self.heap = [] # (score, -order, key, hypothesis), including replaced ones
+    self.order = itertools.count()
+    self.best_score = -math.inf
+    self.created = 0
+    self.pruned = 0
+    self.recombined = 0
+
+  def __len__(self):
+    return len(self.hypotheses)
+
+  def __contains__(self, key):
+    return key in self.hypotheses
+
+  def __getitem__(self, key):
+    return self.hypotheses[key]
+
+  def values(self):
+    return self.hypotheses.values()
+
+  def add(self, key, h):
+    self.created += 1
+    score = self.score(h)
+    if self.threshold is not None and score < self.best_score - self.threshold:
+      self.pruned += 1
+      return False
+    old = self.hypotheses.get(key)
+    if key in self.logprobs:
+      self.recombined += 1
+      if self.logprobs[key] >= h.logprob:
+        if self.arcs is not None and old is not None:
+          self.arcs.setdefault(id(old), []).append(h)
+        return False
+    self.logprobs[key] = h.logprob
+    self.hypotheses[key] = h
+    if self.arcs is not None and old is not None:
+      self.arcs[id(h)] = self.arcs.pop(id(old), []) + [old]
+    heapq.heappush(self.heap, (score, -next(self.order), key, h)) # ties evict the latest first
+    self.best_score = max(self.best_score, score)
+    if len(self.hypotheses) > self.capacity:
+      while True:
+        (_, _, worst_key, worst) = heapq.heappop(self.heap)
+        if self.hypotheses.get(worst_key) is worst: # not since replaced
+          self.remove(worst_key)
+          break
+    return self.hypotheses.get(key) is h
+
+  def best(self):
+    if self.threshold is not None: # the best score may have risen since some were added
+      cutoff = self.best_score - self.threshold
+      for (key, h) in list(self.hypotheses.items()):
+        if self.score(h) < cutoff:
+          self.remove(key)
+    return sorted(self.hypotheses.values(), key=lambda h: -self.score(h))
+
+  def remove(self, key):
+    h = self.hypotheses.pop(key)
+    if self.arcs is not None: # its id may be reused once it is freed
+      self.arcs.pop(id(h), None)
+    self.pruned += 1
+
+# Lazy k-best extraction (Huang and Chiang 2005, algorithm 3) over the
+# search graph: each hypothesis is a node, entered by its own phrase from
+# its predecessor and by those of the hypotheses recombined into it, which
+# alternatives(h) returns. kbest yields (logprob, path) for the derivations
+# ending in any of finals, best first, where path lists the hypotheses
+# whose phrases make up the derivation, in order. The k-th best derivation
+# of a node is only computed when it is asked for.
+def kbest(finals, alternatives):
+  derivations = {} # id(node) -> [(logprob, edge, j)], best first: the j-th best derivation of edge.predecessor, then edge
+  candidates = {} # id(node) -> heap of the next (logprob, edge, j) of each edge
+  order = itertools.count() # breaks ties between equal logprobs
+  def derivation(node, k):
+    found = derivations.get(id(node))
+    if found is None:
+      found = derivations[id(node)] = []
+      candidates[id(node)] = [(-edge.logprob, next(order), edge, 0) for edge in [node] + alternatives(node)]
+      heapq.heapify(candidates[id(node)])
+    heap = candidates[id(node)]
+    while len(found) <= k and heap:
+      (logprob, _, edge, j) = heapq.heappop(heap)
+      found.append((-logprob, edge, j))
+      if edge.predecessor is not None:
+        following = derivation(edge.predecessor, j + 1)
+        if following is not None:
+          heapq.heappush(heap, (-(following[0] + edge.logprob - edge.predecessor.logprob), next(order), edge, j + 1))
+    return found[k] if k < len(found) else None
+  def path(node, k):
+    (_, edge, j) = derivation(node, k)
+    return [] if edge.predecessor is None else path(edge.predecessor, j) + [edge]
+  heap = [(-final.logprob, next(order), final, 0) for final in finals]
+  heapq.heapify(heap)
+  while heap:
+    (logprob, _, final, k) = heapq.heappop(heap)
+    yield (-logprob, path(final, k))
+    following = derivation(final, k + 1)
+    if following is not None:
+      heapq.heappush(heap, (-following[0], next(order), final, k + 1))
+
+NBEST_DERIVATIONS = 100 # derivations examined per entry of an n-best list, at most
+
+# The n best distinct translations, as (english, tm_logprob, logprob)
+def nbest(finals, alternatives, n):
+  translations = []
+  seen = set()
+  for (logprob, path) in itertools.islice(kbest(finals, alternatives), n * NBEST_DERIVATIONS):
+    english = " ".join(h.phrase.english for h in path)
+    if english not in seen:
+      seen.add(english)
+      translations.append((english, sum(h.phrase.logprob for h in path), logprob))
+      if len(translations) == n:
+        break
+  return translations
+
+# The search graph of a sentence, for rescoring without decoding again:
+# nodes are numbered so that edges run from lower to higher numbers, node 0
+# being the initial hypothesis, and each edge is [from, to, tm_logprob,
+# lm_logprob, english], where lm_logprob is the rest of the score the
+# phrase added (including any distortion or </s> score).
+def lattice(finals, alternatives):
+  nodes = {} # id(hypothesis) -> node number
+  edges = []
+  def visit(node):
+    if id(node) not in nodes:
+      entering = [edge for edge in [node] + alternatives(node) if edge.predecessor is not None]
+      for edge in entering:
+        visit(edge.predecessor)
+      nodes[id(node)] = len(nodes) # after its predecessors
+      for edge in entering:
+        step = edge.logprob - edge.predecessor.logprob
+        edges.append([nodes[id(edge.predecessor)], nodes[id(node)], edge.phrase.logprob, step - edge.phrase.logprob, edge.phrase.english])
+    return nodes[id(node)]
+  finals = [visit(final) for final in finals]
+  return {"nodes": len(nodes), "finals": finals, "edges": edges}
+
+def write_nbest(out, i, translations):
+  for (english, tm_logprob, logprob) in translations:
+    out.write("%d ||| %s ||| LM = %f, TM = %f, Total = %f\n" % (i, english, logprob - tm_logprob, tm_logprob, logprob))
+
+def write_lattice(out, i, graph):
+  out.write(json.dumps(dict(sentence=i, **graph)) + "\n")
+
+# Search statistics, written with --stats FILE. A decoder makes a
+# SearchStatistics for each sentence and calls lap(phase) as it finishes
+# each part of the search, which charges the time since the last lap to
+# phase (and to stack n, given one). record(stacks) then gives the
+# sentence's statistics as a dict: the time per phase, the LM phrase
+# scores computed and found in the lm.score_ids cache, and the hypotheses
+# created, recombined and pruned in total and in each of stacks, updated
+# with any keyword arguments (a search without stacks gives its own). All
+# this costs a few clock reads per stack, so the decoders always keep it
+# and only build the record when it is asked for.
+class SearchStatistics:
+  def __init__(self, lm):
+    self.lm = lm
+    self.cache = lm.score_ids.cache_info()
+    self.phases = {}
+    self.stack_seconds = {}
+    self.last = time.perf_counter()
+
+  def lap(self, phase, n=None):
+    now = time.perf_counter()
+    self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+    if n is not None:
+      self.stack_seconds[n] = self.stack_seconds.get(n, 0.0) + now - self.last
+    self.last = now
+
+  def record(self, stacks, **info):
+    cache = self.lm.score_ids.cache_info()
+    hits = cache.hits - self.cache.hits
+    record = dict(seconds=sum(self.phases.values()), phases=self.phases,
+                  lm_calls=hits + cache.misses - self.cache.misses, lm_hits=hits,
+                  created=sum(stack.created for stack in stacks),
+                  recombined=sum(stack.recombined for stack in stacks),
+                  pruned=sum(stack.pruned for stack in stacks),
+                  stacks=[{"hypotheses": len(stack), "created": stack.created, "recombined": stack.recombined,
+                           "pruned": stack.pruned, "seconds": self.stack_seconds.get(n, 0.0)} for (n, stack) in enumerate(stacks)])
+    record.update(info)
+    return record
+
+def write_statistics(out, i, f, record):
+  record = dict(sentence=i, words=len(f), **record)
+  out.write(json.dumps(record) + "\n")
+  return record
+
+SLOWEST_SENTENCES = 5 # listed in the summary
+
+# A summary of the records of a run, for the end of its --stats output.
+def write_summary(out, records):
+  if not records:
+    return
+  seconds = sum(record["seconds"] for record in records)
+  phases = {}
+  for record in records:
+    for (phase, phase_seconds) in record["phases"].items():
+      phases[phase] = phases.get(phase, 0.0) + phase_seconds
+  calls = sum(record["lm_calls"] for record in records)
+  hits = sum(record["lm_hits"] for record in records)
+  out.write("Search statistics: %d sentences in %.2f seconds of decoding\n" % (len(records), seconds))
+  out.write("  time: %s\n" % ", ".join("%s %.2fs (%.0f%%)" % (phase, phase_seconds, 100.0 * phase_seconds / seconds if seconds else 0.0) for (phase, phase_seconds) in phases.items()))
+  out.write("  hypotheses: %d created, %d recombined, %d pruned\n" % tuple(sum(record[field] for record in records) for field in ("created", "recombined", "pruned")))
+  out.write("  LM phrase scores: %d, %.1f%% from the cache\n" % (calls, 100.0 * hits / calls if calls else 0.0))
+  slowest = sorted(records, key=lambda record: -record["seconds"])[:SLOWEST_SENTENCES]
+  out.write("  slowest sentences: %s\n" % ", ".join("%d (%d words, %.2fs)" % (record["sentence"], record["words"], record["seconds"]) for record in slowest))
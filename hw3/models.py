@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 # Simple translation model and language model data structures
+import array
+import bisect
+import functools
+import json
+import os
 import sys
+import numpy
 from collections import namedtuple
 
 # A translation model is a dictionary where keys are tuples of French words
@@ -10,8 +16,12 @@ from collections import namedtuple
 #   phrase(english='what has', logprob=-0.301030009985), 
 #   phrase(english='what has been', logprob=-0.301030009985)]
 # k is a pruning parameter: only the top k translations are kept for each f.
+# filename may also be a model compiled by compile-models (see
+# CompiledTM below), which is detected and loaded lazily.
 phrase = namedtuple("phrase", "english, logprob")
 def TM(filename, k):
+  if is_compiled(filename, "tm"):
+    return CompiledTM(filename, k)
   sys.stderr.write("Reading translation model from %s...\n" % (filename,))
   tm = {}
   for line in open(filename).readlines():
@@ -22,6 +32,131 @@ def TM(filename, k):
     del tm[f][k:] 
   return tm
 
+# Compiled models are a magic line, a one-line JSON header and a set of
+# arrays (64-byte aligned), which are memory-mapped when loaded. Strings
+# are stored as a table: one utf-8 blob and the offsets of its strings.
+COMPILED_MAGIC = b"HW3MODEL 1\n"
+
+def is_compiled(filename, kind):
+  with open(filename, "rb") as f:
+    if f.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+      return False
+    header = json.loads(f.readline())
+  if header["kind"] != kind:
+    raise ValueError("%s is a compiled %s, not a %s" % (filename, header["kind"], kind))
+  return True
+
+def write_compiled(filename, kind, arrays, **info):
+  layout = {}
+  offset = 0
+  for (name, array) in arrays.items():
+    offset += -offset % 64
+    layout[name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+    offset += array.nbytes
+  header = json.dumps(dict(info, kind=kind, arrays=layout)).encode("utf-8") + b"\n"
+  start = len(COMPILED_MAGIC) + len(header)
+  start += -start % 64
+  partial = "%s.%d.tmp" % (filename, os.getpid())
+  with open(partial, "wb") as out:
+    out.write(COMPILED_MAGIC)
+    out.write(header)
+    for (name, array) in arrays.items():
+      out.seek(start + layout[name]["offset"])
+      out.write(array.tobytes())
+  os.replace(partial, filename)
+
+def read_compiled(filename):
+  with open(filename, "rb") as f:
+    f.readline()
+    header = f.readline()
+  start = len(COMPILED_MAGIC) + len(header)
+  start += -start % 64
+  info = json.loads(header)
+  data = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+  arrays = {}
+  for (name, layout) in info.pop("arrays").items():
+    dtype = numpy.dtype(layout["dtype"])
+    count = int(numpy.prod(layout["shape"], dtype=numpy.int64))
+    begin = start + layout["offset"]
+    arrays[name] = data[begin:begin + count * dtype.itemsize].view(dtype).reshape(layout["shape"])
+  return (info, arrays)
+
+def string_arrays(strings):
+  encoded = [s.encode("utf-8") for s in strings]
+  offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+  numpy.cumsum([len(s) for s in encoded], out=offsets[1:])
+  return (numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8), offsets)
+
+class StringTable:
+  # read-only list of strings over a blob and offsets from string_arrays
+  def __init__(self, blob, offsets):
+    self.blob = blob
+    self.offsets = offsets.tolist()
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode("utf-8")
+
+def find(strings, s):
+  # index of s in a sorted list or StringTable, or -1
+  i = bisect.bisect_left(strings, s)
+  return i if i < len(strings) and strings[i] == s else -1
+
+# A compiled translation model holds every French phrase in sorted order,
+# and for each the range of its translations sorted by -logprob, so the
+# top k are a prefix whatever k is. Translations of a French phrase are
+# only materialized when it is first looked up; otherwise it behaves like
+# the dictionary returned by TM (decoders may add entries), except that
+# iterating over it only gives the phrases looked up so far.
+def compile_tm(tm, filename):
+  french = sorted(tm, key=" ".join)
+  english = [p.english for f in french for p in tm[f]]
+  starts = numpy.zeros(len(french) + 1, dtype=numpy.int64)
+  numpy.cumsum([len(tm[f]) for f in french], out=starts[1:])
+  (f_blob, f_offsets) = string_arrays(" ".join(f) for f in french)
+  (e_blob, e_offsets) = string_arrays(english)
+  write_compiled(filename, "tm", {"french": f_blob, "french_offsets": f_offsets, "starts": starts,
+                                  "english": e_blob, "english_offsets": e_offsets,
+                                  "logprobs": numpy.array([p.logprob for f in french for p in tm[f]])})
+
+class CompiledTM(dict):
+  def __init__(self, filename, k):
+    sys.stderr.write("Loading compiled translation model from %s...\n" % (filename,))
+    (_, arrays) = read_compiled(filename)
+    self.k = k
+    self.french = StringTable(arrays["french"], arrays["french_offsets"])
+    self.english = StringTable(arrays["english"], arrays["english_offsets"])
+    self.starts = arrays["starts"]
+    self.logprobs = arrays["logprobs"]
+    self.unknown = set()
+
+  def materialize(self, f):
+    if f in self.unknown:
+      return None
+    i = find(self.french, " ".join(f))
+    if i < 0:
+      self.unknown.add(f)
+      return None
+    start = int(self.starts[i])
+    end = min(int(self.starts[i+1]), start + self.k)
+    phrases = [phrase(self.english[n], float(self.logprobs[n])) for n in range(start, end)]
+    dict.__setitem__(self, f, phrases)
+    return phrases
+
+  def __contains__(self, f):
+    return dict.__contains__(self, f) or self.materialize(f) is not None
+
+  def __missing__(self, f):
+    phrases = self.materialize(f)
+    if phrases is None:
+      raise KeyError(f)
+    return phrases
+
+  def get(self, f, default=None):
+    return self[f] if f in self else default
+
 # # A language model scores sequences of English words, and must account
 # # for both beginning and end of each sequence. Example API usage:
 # lm = models.LM(filename)
@@ -32,30 +167,196 @@ def TM(filename, k):
 #   (lm_state, word_logprob) = lm.score(lm_state, word)
 #   logprob += word_logprob
 # logprob += lm.end(lm_state) # transition to </s>, can also use lm.score(lm_state, "</s>")[1]
-ngram_stats = namedtuple("ngram_stats", "logprob, backoff")
+#
+# Words are stored as integer ids (from 1, in sorted order) and an n-gram
+# as the ids packed into one integer, lm.bits bits each, first word highest.
+# lm.index[n] maps the packed keys of the n-grams to rows of the compact
+# arrays lm.logprobs[n] and lm.backoffs[n], which are filled as the ARPA
+# file is read. An LM state is the packed key of its context words (0 for
+# no context), and lm.context(state) gives back the words. lm.save writes
+# a compiled model, holding the keys of each order sorted (as records of
+# big-endian 32-bit word ids where they do not fit in 63 bits) and the
+# arrays in that order; LM memory-maps the arrays and indexes the keys
+# instead of parsing the ARPA file.
+#
+# lm.score_ids(state, word_ids) scores a whole English phrase, given as the
+# tuple of its word ids (lm.word_ids(english)), returning (new_state,
+# logprob); results are kept in an LRU cache shared by all sentences, whose
+# hits and misses lm.score_ids.cache_info() reports. lm.score_phrase(state,
+# english) does the same for a phrase string.
+LM_PHRASE_CACHE_SIZE = 1 << 16 # (state, phrase) scores kept in the LRU cache
+
 class LM:
   def __init__(self, filename):
+    if is_compiled(filename, "lm"):
+      sys.stderr.write("Loading compiled language model from %s...\n" % (filename,))
+      (info, arrays) = read_compiled(filename)
+      self.words = StringTable(arrays["words"], arrays["word_offsets"])
+      self.vocab = {} # filled in as words are looked up
+      self.bits = max(len(self.words), 1).bit_length()
+      self.mask = (1 << self.bits) - 1
+      self.index, self.logprobs, self.backoffs = [None], [None], [None]
+      for n in range(1, info["order"] + 1):
+        keys = arrays["keys%d" % n]
+        if keys.dtype.kind == "V":
+          ids = keys.view(">u4").reshape(-1, n).astype(object)
+          keys = ids[:, 0]
+          for i in range(1, n):
+            keys = (keys << self.bits) | ids[:, i]
+        self.index.append(dict(zip(keys.tolist(), range(len(keys)))))
+        self.logprobs.append(memoryview(arrays["logprobs%d" % n]))
+        self.backoffs.append(memoryview(arrays["backoffs%d" % n]))
+    else:
+      self.read_arpa(filename)
+    self.order = len(self.index) - 1
+    self.masks = [(1 << (self.bits * n)) - 1 for n in range(self.order + 1)] # of the keys of n words
+    self.state_mask = self.masks[self.order - 1]
+    unk = self.lookup(self.word_id("<unk>"), 1)
+    self.unk_logprob = unk[0] if unk is not None else float("-inf")
+    self.end_id = self.word_id("</s>")
+    self.best = None # see best_score
+    self.score_ids = functools.lru_cache(maxsize=LM_PHRASE_CACHE_SIZE)(self.score_words)
+
+  def read_arpa(self, filename):
     sys.stderr.write("Reading language model from %s...\n" % (filename,))
-    self.table = {}
+    # The 1-grams come first and give the vocabulary, so the higher orders
+    # are encoded to packed keys as they are read.
+    self.words = None
+    self.index, self.logprobs, self.backoffs = [None], [None], [None]
+    unigrams = {}
+    skipped = 0
     for line in open(filename):
       entry = line.strip().split("\t")
       if len(entry) > 1 and entry[0] != "ngram":
-        (logprob, ngram, backoff) = (float(entry[0]), tuple(entry[1].split()), float(entry[2] if len(entry)==3 else 0.0))
-        self.table[ngram] = ngram_stats(logprob, backoff)
+        words = entry[1].split()
+        if len(words) == 1 and self.words is None:
+          unigrams[words[0]] = (float(entry[0]), float(entry[2] if len(entry)==3 else 0.0))
+          continue
+        if self.words is None:
+          self.set_vocabulary(unigrams)
+          (vocab, bits) = (self.vocab, self.bits)
+        try:
+          key = 0
+          for word in words:
+            key = (key << bits) | vocab[word]
+        except KeyError: # not a valid ARPA file, whose n-grams only use its 1-grams
+          skipped += 1
+          continue
+        n = len(words)
+        while len(self.index) <= n:
+          self.index.append({})
+          self.logprobs.append(array.array("d"))
+          self.backoffs.append(array.array("d"))
+        logprobs = self.logprobs[n]
+        self.index[n][key] = len(logprobs) # a repeated n-gram's last entry wins
+        logprobs.append(float(entry[0]))
+        self.backoffs[n].append(float(entry[2] if len(entry)==3 else 0.0))
+    if self.words is None:
+      self.set_vocabulary(unigrams)
+    if skipped:
+      sys.stderr.write("Skipped %d n-grams of %s with words that are not 1-grams\n" % (skipped, filename))
+
+  def set_vocabulary(self, unigrams):
+    # unigrams maps each word to its (logprob, backoff)
+    self.words = sorted(unigrams)
+    self.vocab = {word: i + 1 for (i, word) in enumerate(self.words)}
+    self.bits = max(len(self.words), 1).bit_length()
+    self.mask = (1 << self.bits) - 1
+    self.index.append({i + 1: i for i in range(len(self.words))})
+    self.logprobs.append(array.array("d", (unigrams[word][0] for word in self.words)))
+    self.backoffs.append(array.array("d", (unigrams[word][1] for word in self.words)))
+
+  def save(self, filename):
+    (words, offsets) = string_arrays(self.words[i] for i in range(len(self.words)))
+    arrays = {"words": words, "word_offsets": offsets}
+    for n in range(1, self.order + 1):
+      keys = sorted(self.index[n])
+      rows = numpy.array([self.index[n][key] for key in keys], dtype=numpy.int64)
+      if self.bits * n > 63:
+        arrays["keys%d" % n] = self.records(numpy.array([self.unpack(key, n) for key in keys], dtype=">u4").reshape(-1, n))
+      else:
+        arrays["keys%d" % n] = numpy.array(keys, dtype=numpy.int64)
+      arrays["logprobs%d" % n] = numpy.asarray(self.logprobs[n], dtype=numpy.float64)[rows]
+      arrays["backoffs%d" % n] = numpy.asarray(self.backoffs[n], dtype=numpy.float64)[rows]
+    write_compiled(filename, "lm", arrays, order=self.order)
+
+  def word_id(self, word):
+    # 0 for words not in the LM
+    word_id = self.vocab.get(word)
+    if word_id is None:
+      word_id = self.vocab[word] = find(self.words, word) + 1
+    return word_id
+
+  def records(self, ids):
+    # the rows of an (n-grams, n) array of big-endian word ids as one record each
+    return numpy.ascontiguousarray(ids).view("V%d" % (4 * ids.shape[1])).reshape(-1)
+
+  def unpack(self, key, n):
+    return tuple((key >> (self.bits * (n - 1 - i))) & self.mask for i in range(n))
+
+  def lookup(self, key, n):
+    # (logprob, backoff) of the packed n-gram key, or None
+    row = self.index[n].get(key)
+    return (self.logprobs[n][row], self.backoffs[n][row]) if row is not None else None
+
+  def context(self, state):
+    words = []
+    while state:
+      words.append(self.words[(state & self.mask) - 1])
+      state >>= self.bits
+    return tuple(reversed(words))
 
   def begin(self):
-    return ("<s>",)
+    return self.word_id("<s>")
+
+  def word_ids(self, english):
+    return tuple(self.word_id(word) for word in english.split())
 
   def score(self, state, word):
-    ngram = state + (word,)
+    word_id = self.vocab.get(word)
+    return self.score_id(state, word_id if word_id is not None else self.word_id(word))
+
+  def score_words(self, state, word_ids):
+    logprob = 0.0
+    for word_id in word_ids:
+      (state, word_logprob) = self.score_id(state, word_id)
+      logprob += word_logprob
+    return (state, logprob)
+
+  def score_phrase(self, state, english):
+    return self.score_ids(state, self.word_ids(english))
+
+  def score_id(self, state, word_id):
     score = 0.0
-    while len(ngram)> 0:
-      if ngram in self.table:
-        return (ngram[-2:], score + self.table[ngram].logprob)
+    (bits, index) = (self.bits, self.index)
+    n = (state.bit_length() + bits - 1) // bits + 1
+    ngram = (state << bits) | word_id
+    while n > 0:
+      row = index[n].get(ngram) if word_id else None
+      if row is not None:
+        return (ngram & self.state_mask, score + self.logprobs[n][row])
       else: #backoff
-        score += self.table[ngram[:-1]].backoff if len(ngram) > 1 else 0.0 
-        ngram = ngram[1:]
-    return ((), score + self.table[("<unk>",)].logprob)
+        row = index[n-1].get(ngram >> bits) if n > 1 else None
+        score += self.backoffs[n-1][row] if row is not None else 0.0
+        n -= 1
+        ngram &= self.masks[n]
+    return (0, score + self.unk_logprob)
     
   def end(self, state):
-    return self.score(state, "</s>")[1]
+    return self.score_id(state, self.end_id)[1]
+
+  def best_score(self, word):
+    # An upper bound on lm.score(state, word)[1] over all states: the best
+    # logprob of an n-gram ending in word, plus the most the backoffs of a
+    # context could add. Search heuristics use it to stay admissible.
+    if self.best is None:
+      self.best = numpy.full(len(self.words) + 1, -numpy.inf)
+      for n in range(1, self.order + 1):
+        last = numpy.fromiter((key & self.mask for key in self.index[n]), dtype=numpy.int64, count=len(self.index[n]))
+        rows = numpy.fromiter(self.index[n].values(), dtype=numpy.int64, count=len(self.index[n]))
+        numpy.maximum.at(self.best, last, numpy.asarray(self.logprobs[n], dtype=numpy.float64)[rows])
+      backoffs = [float(numpy.max(self.backoffs[n], initial=0.0)) for n in range(1, self.order)]
+      self.best += sum(backoffs)
+      self.best[0] = self.unk_logprob + sum(backoffs) # also where a word's n-grams are all missed
+      numpy.maximum(self.best, self.best[0], out=self.best)
+    return float(self.best[self.word_id(word)])